@@ -1,33 +1,59 @@
 import os
-import json
-from typing import Any, Dict, List, Tuple
+import re
+import orjson
+import pickle
+import time
+import hashlib
+import threading
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor, TimeoutError as FutureTimeoutError
+from typing import TYPE_CHECKING, Any, Dict, List, NamedTuple, Optional, Tuple
 from dotenv import load_dotenv
+import numpy as np
 
 # Vercel Python Serverless Function
 # Exposed at /api/rag
 
-from langchain_community.vectorstores import FAISS
-from langchain_google_genai import GoogleGenerativeAIEmbeddings, ChatGoogleGenerativeAI
-from langchain.text_splitter import RecursiveCharacterTextSplitter
-from langchain.docstore.document import Document
-from langchain.schema import BaseMessage
-from langchain.retrievers.document_compressors import DocumentCompressorPipeline
-from langchain.retrievers import ContextualCompressionRetriever
-from langchain_core.vectorstores.utils import maximal_marginal_relevance
+# Heavy LangChain / Gemini / LangGraph modules are imported on first use to keep cold start short
+if TYPE_CHECKING:
+    from langchain_google_genai import GoogleGenerativeAIEmbeddings, ChatGoogleGenerativeAI
 
-from langgraph.graph import StateGraph, END
-
-load_dotenv()
+# Read .env only for local ad-hoc runs; serverless gets env from the platform and
+# tools/rag_cli.py loads it before importing this module.
+if __name__ == "__main__":
+    load_dotenv()
 
 ROOT = os.path.dirname(os.path.dirname(__file__))
 DATA_DIR = os.path.join(ROOT, "data", "faiss")
 
+# Env is snapshotted once per container; nothing below re-reads it per request
 GOOGLE_API_KEY = os.getenv("GOOGLE_API_KEY")
 EMBED_MODEL = os.getenv("EMBED_MODEL", "models/text-embedding-004")
 CHAT_MODEL = os.getenv("CHAT_MODEL", "gemini-1.5-flash")
+FAISS_NPROBE = int(os.getenv("FAISS_NPROBE", "10"))
+PREFETCH_BLOCK = 16 << 20
+
+
+def _prefetch():
+    """Pull the index files into the page cache while the rest of the module imports."""
+    for name in ("nec", "wattmonk"):
+        path = os.path.join(DATA_DIR, name, "index.faiss")
+        try:
+            fd = os.open(path, os.O_RDONLY)
+        except OSError:
+            continue
+        try:
+            while os.read(fd, PREFETCH_BLOCK):
+                pass
+        except OSError:
+            pass
+        finally:
+            os.close(fd)
+
+# Runs once per cold container
+threading.Thread(target=_prefetch, name="faiss-prefetch", daemon=True).start()
 
 def sanitize_model(name: str) -> str:
-    import re
     base = re.sub(r"-00\d$", "", name or "")
     allowed = {"gemini-1.5-flash", "gemini-1.5-pro"}
     return base if base in allowed else "gemini-1.5-flash"
@@ -36,33 +62,217 @@ def sanitize_model(name: str) -> str:
 KEY_OVERRIDE = None  # type: ignore
 
 def get_key():
-    return KEY_OVERRIDE or os.getenv("GOOGLE_API_KEY")
+    return KEY_OVERRIDE or GOOGLE_API_KEY
 
 # ----------------------- Utilities -----------------------
 
+_NEC_RE = re.compile(r"\bnec\b|national electrical code|nfpa 70|article ", re.I)
+_WM_RE = re.compile(r"wattmonk|\bpolicy\b|\bsla\b|\bpricing\b|\bservices\b|turnaround", re.I)
+
+
+# Token-set A/B variant (FAST_CLASSIFY=1): one tokenizing pass, then C-level set
+# intersections. It routes on whole tokens, so it is not equivalent to the regex path:
+# "grounding" routes to NEC here, "particle" does not, and phrase checks ignore word order.
+FAST_CLASSIFY = os.getenv("FAST_CLASSIFY", "0") == "1"
+_TOKEN_RE = re.compile(r"[a-z0-9]+")
+# "nfpa" rather than "nfpa70": the tokenizer splits "NFPA 70" into two tokens
+_NEC_TOKENS = frozenset({"nec", "nfpa", "grounding", "article"})
+_NEC_PHRASES = (frozenset({"national", "electrical", "code"}),)
+_WM_TOKENS = frozenset({"wattmonk", "policy", "sla", "pricing", "services", "turnaround"})
+
+
+def _classify_tokens(q: str) -> str:
+    toks = set(_TOKEN_RE.findall(q.lower()))
+    if toks & _NEC_TOKENS or any(p <= toks for p in _NEC_PHRASES):
+        return "nec"
+    if toks & _WM_TOKENS:
+        return "wattmonk"
+    return "general"
+
+
 def classify_intent(q: str) -> str:
-    s = (q or "").lower()
-    if any(k in s for k in [" nec ", "national electrical code", "nfpa 70", "article "]):
+    q = q or ""
+    if FAST_CLASSIFY:
+        return _classify_tokens(q)
+    if _NEC_RE.search(q):
         return "nec"
-    if any(k in s for k in ["wattmonk", "policy", "sla", "pricing", "services", "turnaround"]):
+    if _WM_RE.search(q):
         return "wattmonk"
     return "general"
 
 
+class Pool(NamedTuple):
+    """A loaded FAISS index plus its display dicts, indexed by FAISS id."""
+    index: Any
+    docs: List[Dict[str, Any]]
+    l2: bool  # older indexes were built with L2 distance instead of inner product
+
+
+# Warm invocations reuse the same module, so keep pools and embedding clients
+# around instead of re-reading the index from disk on every request.
+_VS_CACHE: Dict[str, Optional[Pool]] = {}
+_VS_LOCK = threading.Lock()
+
+# Keys can come from the request body, so per-key client caches are bounded LRUs
+CLIENT_CACHE_SIZE = int(os.getenv("CLIENT_CACHE_SIZE", "8"))
+_EMB_CACHE: "OrderedDict[str, GoogleGenerativeAIEmbeddings]" = OrderedDict()
+_EMB_LOCK = threading.Lock()
+
+
+def _lru_get_or_create(cache: OrderedDict, lock: threading.Lock, key: Any, factory):
+    with lock:
+        value = cache.get(key)
+        if value is None:
+            value = cache[key] = factory()
+            while len(cache) > CLIENT_CACHE_SIZE:
+                cache.popitem(last=False)
+        else:
+            cache.move_to_end(key)
+        return value
+
+
+def get_embeddings(key: str):
+    if not key:
+        return None
+    from langchain_google_genai import GoogleGenerativeAIEmbeddings
+    return _lru_get_or_create(
+        _EMB_CACHE, _EMB_LOCK, key,
+        lambda: GoogleGenerativeAIEmbeddings(model=EMBED_MODEL, google_api_key=key),
+    )
+
+
+def _doc_to_dict(d) -> Dict[str, Any]:
+    return {
+        "text": d.page_content,
+        "source": d.metadata.get("source") or d.metadata.get("file", ""),
+        "file": d.metadata.get("file", ""),
+    }
+
+
+def _load_doc_meta(path: str, ntotal: int) -> List[Dict[str, Any]]:
+    meta_path = os.path.join(path, "doc_meta.jsonl")
+    if os.path.exists(meta_path):
+        with open(meta_path, "rb") as f:
+            return [orjson.loads(line) for line in f if line.strip()]
+    # Indexes built before doc_meta.jsonl existed: convert the pickled docstore once at load
+    with open(os.path.join(path, "index.pkl"), "rb") as f:
+        docstore, index_to_docstore_id = pickle.load(f)
+    return [_doc_to_dict(docstore.search(index_to_docstore_id[i])) for i in range(ntotal)]
+
+
 def load_vs(name: str):
-    path = os.path.join(DATA_DIR, name)
-    if not os.path.exists(path):
+    # None is cached too: data/faiss is read-only at runtime, so a missing or
+    # EMPTY-only index folder stays that way for the life of the container.
+    if name in _VS_CACHE:
+        return _VS_CACHE[name]
+    with _VS_LOCK:
+        if name in _VS_CACHE:
+            return _VS_CACHE[name]
+        _VS_CACHE[name] = pool = _open_pool(os.path.join(DATA_DIR, name))
+        return pool
+
+
+def _open_pool(path: str):
+    index_path = os.path.join(path, "index.faiss")
+    if not os.path.exists(index_path):
         return None
-    key = get_key()
-    embeddings = GoogleGenerativeAIEmbeddings(model=EMBED_MODEL, google_api_key=key) if key else None
+    import faiss
     try:
-        vs = FAISS.load_local(path, embeddings=embeddings, allow_dangerous_deserialization=True)
-        return vs
+        # faiss only honours IO_FLAG_MMAP for IVF inverted lists; flat/SQ codes are read
+        # into memory as usual, which is fast since _prefetch already warmed the page cache
+        index = faiss.read_index(index_path, faiss.IO_FLAG_MMAP)
+        docs = _load_doc_meta(path, index.ntotal)
     except Exception:
         return None
+    if hasattr(index, "nprobe"):  # IVF indexes only
+        index.nprobe = FAISS_NPROBE
+    return Pool(index, docs, index.metric_type == faiss.METRIC_L2)
+
+
+class QueryCache:
+    """Thread-safe LRU cache with a TTL for retrieval results."""
+
+    def __init__(self, max_size: int = 512, ttl_seconds: float = 300.0):
+        self.max_size = max_size
+        self.ttl_seconds = ttl_seconds
+        self._data: "OrderedDict[str, Tuple[float, Any]]" = OrderedDict()
+        self._lock = threading.RLock()
+        self.stats = {"hits": 0, "misses": 0, "evictions": 0}
+
+    @staticmethod
+    def make_key(query: str, hint: str, k: int) -> str:
+        return hashlib.blake2b((query + "|" + hint + "|" + str(k)).encode("utf-8")).hexdigest()
+
+    def get(self, key: str):
+        with self._lock:
+            item = self._data.get(key)
+            if item is None:
+                self.stats["misses"] += 1
+                return None
+            inserted, value = item
+            if inserted + self.ttl_seconds < time.monotonic():
+                del self._data[key]
+                self.stats["evictions"] += 1
+                self.stats["misses"] += 1
+                return None
+            self._data.move_to_end(key)
+            self.stats["hits"] += 1
+            return value
+
+    def put(self, key: str, value: Any) -> None:
+        if self.max_size <= 0:
+            return
+        with self._lock:
+            self._data[key] = (time.monotonic(), value)
+            self._data.move_to_end(key)
+            while len(self._data) > self.max_size:
+                self._data.popitem(last=False)
+                self.stats["evictions"] += 1
+
+    def snapshot(self) -> Dict[str, int]:
+        with self._lock:
+            return dict(self.stats, size=len(self._data))
+
+
+_QUERY_CACHE = QueryCache(
+    max_size=int(os.getenv("QUERY_CACHE_SIZE", "512")),
+    ttl_seconds=float(os.getenv("QUERY_CACHE_TTL", "300")),
+)
+
+_EXEC = ThreadPoolExecutor(max_workers=4)
+
+# Query vectors are deterministic per model, so a plain LRU (no TTL) is enough.
+# Also lets a future MMR pass reuse the vector without a second embed call.
+QVEC_CACHE_SIZE = int(os.getenv("QVEC_CACHE_SIZE", "256"))
+_QVEC_CACHE: "OrderedDict[str, np.ndarray]" = OrderedDict()
+_QVEC_LOCK = threading.Lock()
+
+
+def _embed_query_cached(embeddings, query: str) -> np.ndarray:
+    key = hashlib.sha1((EMBED_MODEL + "|" + query).encode("utf-8")).hexdigest()
+    with _QVEC_LOCK:
+        qvec = _QVEC_CACHE.get(key)
+        if qvec is not None:
+            _QVEC_CACHE.move_to_end(key)
+            return qvec
+    qvec = np.asarray(embeddings.embed_query(query), dtype="float32")
+    norm = float(np.linalg.norm(qvec))
+    if norm > 0:
+        qvec /= norm  # unit length so inner product == cosine
+    with _QVEC_LOCK:
+        _QVEC_CACHE[key] = qvec
+        while len(_QVEC_CACHE) > QVEC_CACHE_SIZE:
+            _QVEC_CACHE.popitem(last=False)
+    return qvec
+
+
+def retrieve(query: str, hint: str, k: int = 6) -> Tuple[List[Dict[str, Any]], List[float]]:
+    cache_key = QueryCache.make_key(query or "", hint or "", k)
+    cached = _QUERY_CACHE.get(cache_key)
+    if cached is not None:
+        docs, scores = cached
+        return list(docs), list(scores)
 
-
-def retrieve(query: str, hint: str, k: int = 6) -> Tuple[List[Document], List[float]]:
     pools = []
     if hint == "nec":
         nec = load_vs("nec")
@@ -79,58 +289,121 @@ def retrieve(query: str, hint: str, k: int = 6) -> Tuple[List[Document], List[fl
     if not pools:
         return [], []
 
-    # concat results by score, do MMR selection at the end
-    candidates: List[Tuple[Document, float]] = []
-    for vs in pools:
+    embeddings = get_embeddings(get_key() or "")
+    if embeddings is None:
+        return [], []
+    # Embed once and reuse the vector for every pool
+    try:
+        qvec = _embed_query_cached(embeddings, query)
+    except Exception:
+        return [], []
+
+    def _search(pool: Pool) -> List[Tuple[Dict[str, Any], float]]:
         try:
-            docs_and_scores = vs.similarity_search_with_score(query, k=k*2)
-            candidates.extend(docs_and_scores)
+            dists, ids = pool.index.search(qvec.reshape(1, -1), k*2)
         except Exception:
-            continue
+            return []
+        # Older L2 indexes over unit vectors: ||a - b||^2 = 2 - 2 cos
+        sims = 1.0 - dists[0] / 2.0 if pool.l2 else dists[0]
+        return [(pool.docs[i], float(s)) for i, s in zip(ids[0], sims) if i >= 0]
+
+    # Independent indexes: search them concurrently, then concat results by score
+    results = _EXEC.map(_search, pools) if len(pools) > 1 else map(_search, pools)
+    candidates: List[Tuple[Dict[str, Any], float]] = [c for res in results for c in res]
 
     if not candidates:
         return [], []
 
     # Simplify: avoid extra embedding calls; rely on FAISS ranking to reduce quota usage
-    candidates.sort(key=lambda x: x[1])  # lower distance better
-    docs = [d for d,_ in candidates[:k]]
-    scores = [1.0/(1.0+s) for _,s in candidates[:k]]
+    scores_arr = np.fromiter((s for _, s in candidates), dtype=np.float32, count=len(candidates))
+    if len(candidates) > k:
+        idx = np.argpartition(-scores_arr, k)[:k]
+    else:
+        idx = np.arange(len(candidates))
+    idx = idx[np.argsort(-scores_arr[idx], kind="stable")]  # higher cosine better
+    docs = [candidates[i][0] for i in idx]
+    scores = scores_arr[idx].tolist()
+    _QUERY_CACHE.put(cache_key, (tuple(docs), tuple(scores)))
     return docs, scores
 
 
 def decide_mode(scores: List[float], intent: str) -> str:
     max_s = max(scores) if scores else 0.0
-    if intent in ("nec", "wattmonk") and max_s > 0.25:
+    # Scores are cosine similarities in [-1, 1]
+    if intent in ("nec", "wattmonk") and max_s > 0.5:
         return "rag"
-    if max_s > 0.7:
+    if max_s > 0.75:
         return "rag"
     return "general"
 
 
 ENABLE_MEMORY_SUMMARY = os.getenv("ENABLE_MEMORY_SUMMARY", "0") == "1"
+# Upper bound the handler waits for the background summary before replying without it
+SUMMARY_TIMEOUT = float(os.getenv("SUMMARY_TIMEOUT", "3.0"))
+# Separate from _EXEC so a slow (timed-out, still running) summary never queues retrieval
+_SUMMARY_EXEC = ThreadPoolExecutor(max_workers=2)
 
-def summarize_history(messages: List[Dict[str, str]], model_name: str = CHAT_MODEL) -> str:
-    if not ENABLE_MEMORY_SUMMARY:
-        return ""
-    key = get_key()
-    if not messages or not key:
-        return ""
+
+def should_summarize(messages: List[Dict[str, str]]) -> bool:
     # Throttle: only summarize every 6th message to limit cost
-    if len(messages) % 6 != 0:
+    return ENABLE_MEMORY_SUMMARY and bool(messages) and len(messages) % 6 == 0
+
+_CHAT_CACHE: "OrderedDict[Tuple[str, str], ChatGoogleGenerativeAI]" = OrderedDict()
+_CHAT_LOCK = threading.Lock()
+
+
+def get_chat_model(model_name: str, key: str):
+    from langchain_google_genai import ChatGoogleGenerativeAI
+    cache_key = (sanitize_model(model_name), key)
+    return _lru_get_or_create(
+        _CHAT_CACHE, _CHAT_LOCK, cache_key,
+        lambda: ChatGoogleGenerativeAI(model=cache_key[0], google_api_key=key, temperature=0.3, max_output_tokens=200),
+    )
+
+
+def summarize_history(messages: List[Dict[str, str]], model_name: str = CHAT_MODEL, key: str = None) -> str:
+    if not should_summarize(messages):
+        return ""
+    # Key is passed explicitly when running off the request thread
+    key = key or get_key()
+    if not key:
         return ""
-    model = ChatGoogleGenerativeAI(model=sanitize_model(model_name), google_api_key=key, temperature=0.3)
-    last = messages[-20:]
+    model = get_chat_model(model_name, key)
+    last = messages[-10:]
     text = "\n".join([f"{m.get('role')}: {m.get('content')}" for m in last])
-    prompt = ("Summarize the following conversation briefly but keep key facts, user goals, constraints, and any conclusions.\n\n" + text)
+    prompt = ("Summarize the following conversation briefly (under 200 tokens) but keep key facts, user goals, constraints, and any conclusions.\n\n" + text)
     try:
         out = model.invoke(prompt)
         return getattr(out, 'content', '') or ''
     except Exception:
         return ""
 
+# The router is a straight line (classify -> retrieve), so the hot path runs it
+# inline; the LangGraph version stays available via RAG_USE_LANGGRAPH=1 for debugging.
+USE_LANGGRAPH = os.getenv("RAG_USE_LANGGRAPH", "0") == "1"
+
+def _invoke_fast(query: str) -> Dict[str, Any]:
+    intent = classify_intent(query)
+    docs, scores = retrieve(query, intent)
+    return {
+        "query": query,
+        "intent": intent,
+        "docs": docs,
+        "scores": scores,
+        "mode": decide_mode(scores, intent),
+    }
+
+
+def run_query(query: str) -> Dict[str, Any]:
+    if USE_LANGGRAPH:
+        return _get_graph().invoke({"query": query})
+    return _invoke_fast(query)
+
 # ----------------------- LangGraph (lightweight router) -----------------------
 
 def build_graph():
+    from langgraph.graph import StateGraph, END
+
     def _start(state: Dict[str, Any]):
         q = state.get("query", "")
         state["intent"] = classify_intent(q)
@@ -140,13 +413,7 @@ def build_graph():
         q = state.get("query", "")
         intent = state.get("intent", "general")
         docs, scores = retrieve(q, intent)
-        state["docs"] = [
-            {
-                "text": d.page_content,
-                "source": d.metadata.get("source") or d.metadata.get("file", ""),
-                "metadata": d.metadata,
-            } for d in docs
-        ]
+        state["docs"] = docs
         state["scores"] = scores
         state["mode"] = decide_mode(scores, intent)
         return state
@@ -162,7 +429,13 @@ def build_graph():
     g.add_edge("retrieve", END)
     return g.compile()
 
-_graph = build_graph()
+_graph = None
+
+
+def _get_graph():
+    global _graph
+    _graph = _graph or build_graph()
+    return _graph
 
 # ----------------------- Handler -----------------------
 
@@ -173,13 +446,21 @@ def handler(request):  # vercel python serverless entry
         if request.method == "OPTIONS":
             return Response(status=200, headers={"Access-Control-Allow-Origin": "*", "Access-Control-Allow-Headers": "*"})
         body_text = request.get_data(as_text=True) or "{}"
-        data = json.loads(body_text)
+        data = orjson.loads(body_text)
         KEY_OVERRIDE = data.get("apiKey") or None
         messages = data.get("messages", [])
         query = messages[-1].get("content") if messages else data.get("query", "")
-        state = {"query": query}
-        result = _graph.invoke(state)
-        memory_summary = summarize_history(messages)
+        # Overlap the summarizer LLM call with retrieval; most requests skip it entirely
+        summary_fut = None
+        if should_summarize(messages) and get_key():
+            summary_fut = _SUMMARY_EXEC.submit(summarize_history, messages, CHAT_MODEL, get_key())
+        result = run_query(query)
+        memory_summary = ""
+        if summary_fut is not None:
+            try:
+                memory_summary = summary_fut.result(timeout=SUMMARY_TIMEOUT)
+            except FutureTimeoutError:
+                summary_fut.cancel()  # drops it if still queued; a running call finishes on its own pool
 
         # Shape response for Node orchestrator
         docs = result.get("docs", [])
@@ -189,8 +470,8 @@ def handler(request):  # vercel python serverless entry
             out_docs.append({
                 "id": i+1,
                 "text": d.get("text", ""),
-                "source": (d.get("metadata", {}) or {}).get("source") or d.get("source") or "",
-                "file": (d.get("metadata", {}) or {}).get("file", ""),
+                "source": d.get("source", ""),
+                "file": d.get("file", ""),
                 "score": scores[i] if i < len(scores) else 0.0,
             })
 
@@ -199,10 +480,11 @@ def handler(request):  # vercel python serverless entry
             "mode": result.get("mode", "general"),
             "docs": out_docs,
             "memory_summary": memory_summary,
+            "cache": _QUERY_CACHE.snapshot(),
         }
-        return Response(response=json.dumps(resp), status=200, headers={"Content-Type": "application/json", "Access-Control-Allow-Origin": "*"})
+        return Response(response=orjson.dumps(resp), status=200, headers={"Content-Type": "application/json", "Access-Control-Allow-Origin": "*"})
     except Exception as e:
-        return Response(response=json.dumps({"error": str(e)}), status=500, headers={"Content-Type": "application/json"})
+        return Response(response=orjson.dumps({"error": str(e)}), status=500, headers={"Content-Type": "application/json"})
     finally:
         try:
             KEY_OVERRIDE = None
@@ -216,6 +498,6 @@ if __name__ == "__main__":
     class DummyReq:
         method = "POST"
         def get_data(self, as_text=False):
-            return json.dumps({"messages": [{"role":"user","content":"What does NEC say about grounding?"}]})
+            return orjson.dumps({"messages": [{"role":"user","content":"What does NEC say about grounding?"}]}).decode()
     print(handler(DummyReq()).get_data(as_text=True))
 
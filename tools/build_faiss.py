@@ -1,13 +1,20 @@
 import os
 import pathlib
 import json
+import uuid
+from concurrent.futures import ThreadPoolExecutor
 from typing import List
 from dotenv import load_dotenv
 
+import faiss
+import numpy as np
+
 from langchain_community.document_loaders import PyPDFLoader, Docx2txtLoader
 from langchain.text_splitter import RecursiveCharacterTextSplitter
 from langchain_google_genai import GoogleGenerativeAIEmbeddings
 from langchain_community.vectorstores import FAISS
+from langchain_community.docstore.in_memory import InMemoryDocstore
+from langchain_community.vectorstores.utils import DistanceStrategy
 
 load_dotenv()
 
@@ -19,26 +26,80 @@ NEC_PATH = ROOT / "2017-NEC-Code-2.pdf"
 WM_PATH = ROOT / "Wattmonk Information.docx"
 
 CHUNK_SIZE = int(os.getenv("CHUNK_SIZE", "1200"))
-CHUNK_OVERLAP = int(os.getenv("CHUNK_OVERLAP", "200"))
+CHUNK_OVERLAP = int(os.getenv("CHUNK_OVERLAP", "100"))
+
+# Structure-aware separators (regex), tried in order before the plain character fallbacks.
+# NEC: split on "ARTICLE NNN" headings (alone on their line, which skips the
+# "ARTICLE 90 — INTRODUCTION" page running headers) and "NNN.NN " section numbers.
+# Wattmonk DOCX: docx2txt emits headings as short standalone lines after a blank line.
+# The splitter keeps separators at the start of the next piece (good for headings), so
+# the sentence split is a zero-width lookbehind: the ". " stays with its sentence.
+SEPARATORS = {
+    "nec": [r"\nARTICLE \d+\n", r"\n\d+\.\d+ ", r"\n\n", r"\n", r"(?<=\. )", " ", ""],
+    "wattmonk": [r"\n\n+(?=[^\n.]{1,80}\n)", r"\n\n", r"\n", r"(?<=\. )", " ", ""],
+}
+EMBED_BATCH = int(os.getenv("EMBED_BATCH", "100"))
+EMBED_WORKERS = int(os.getenv("EMBED_WORKERS", "8"))
+
+# IVF-PQ settings; corpora too small to train the quantizers fall back to a flat index
+PQ_M = int(os.getenv("PQ_M", "16"))
+PQ_NBITS = int(os.getenv("PQ_NBITS", "8"))
+MIN_IVF_POINTS = int(os.getenv("MIN_IVF_POINTS", "10000"))  # ~39 points per PQ centroid
+# Storage precision for the flat fallback: "fp16" halves vector bytes, "8bit" quarters them
+SQ_TYPE = os.getenv("SQ_TYPE", "fp16")
+SQ_TYPES = {"fp16": faiss.ScalarQuantizer.QT_fp16, "8bit": faiss.ScalarQuantizer.QT_8bit}
 
 GOOGLE_API_KEY = os.getenv("GOOGLE_API_KEY")
 if not GOOGLE_API_KEY:
     print("[WARN] GOOGLE_API_KEY not set. This script requires a valid key for embeddings.")
 
 
-def load_docs() -> List:
-    docs = []
-    if NEC_PATH.exists():
-        print("Loading NEC PDF...")
-        docs += PyPDFLoader(str(NEC_PATH)).load()
-    else:
-        print("[WARN] NEC PDF not found at", NEC_PATH)
-    if WM_PATH.exists():
-        print("Loading Wattmonk DOCX...")
-        docs += Docx2txtLoader(str(WM_PATH)).load()
+def load_docs(path: pathlib.Path, loader_cls, label: str) -> List:
+    if not path.exists():
+        print(f"[WARN] {label} not found at", path)
+        return []
+    print(f"Loading {label}...")
+    return loader_cls(str(path)).load()
+
+
+def embed_texts(embeddings, texts: List[str]) -> np.ndarray:
+    """Embed in EMBED_BATCH-sized requests; the pool size (EMBED_WORKERS) caps requests in flight."""
+    batches = [texts[i:i+EMBED_BATCH] for i in range(0, len(texts), EMBED_BATCH)]
+    with ThreadPoolExecutor(max_workers=EMBED_WORKERS) as pool:
+        vectors = [v for batch in pool.map(embeddings.embed_documents, batches) for v in batch]
+    return np.asarray(vectors, dtype="float32")
+
+
+def make_index(mat: np.ndarray):
+    """IVF-PQ for large corpora, scalar-quantized flat for small ones. Trains if needed.
+
+    Vectors are expected to be L2-normalized; both indexes score by inner product (cosine).
+    """
+    n, d = mat.shape
+    if n < MIN_IVF_POINTS or d % PQ_M != 0:
+        qtype = SQ_TYPES.get(SQ_TYPE, faiss.ScalarQuantizer.QT_fp16)
+        print(f"Using IndexScalarQuantizer ({SQ_TYPE}, {n} vectors)")
+        index = faiss.IndexScalarQuantizer(d, qtype, faiss.METRIC_INNER_PRODUCT)
     else:
-        print("[WARN] Wattmonk DOCX not found at", WM_PATH)
-    return docs
+        nlist = max(1, min(100, n // 40))
+        quantizer = faiss.IndexFlatIP(d)
+        index = faiss.IndexIVFPQ(quantizer, d, nlist, PQ_M, PQ_NBITS, faiss.METRIC_INNER_PRODUCT)
+        print(f"Training IndexIVFPQ (nlist={nlist}, M={PQ_M}, nbits={PQ_NBITS}) on {n} vectors")
+    if not index.is_trained:
+        index.train(mat)
+    return index
+
+
+def write_doc_meta(out_dir: pathlib.Path, chunks: List):
+    """One display dict per chunk, in FAISS id order, so retrieval can skip Document objects."""
+    with open(out_dir / "doc_meta.jsonl", "w", encoding="utf-8") as f:
+        for c in chunks:
+            md = c.metadata
+            f.write(json.dumps({
+                "text": c.page_content,
+                "source": md.get("source") or md.get("file", ""),
+                "file": md.get("file", ""),
+            }, ensure_ascii=False) + "\n")
 
 
 def build_index(name: str, docs: List):
@@ -48,7 +109,12 @@ def build_index(name: str, docs: List):
         print(f"[INFO] Created empty index folder for {name}")
         return
 
-    splitter = RecursiveCharacterTextSplitter(chunk_size=CHUNK_SIZE, chunk_overlap=CHUNK_OVERLAP)
+    splitter = RecursiveCharacterTextSplitter(
+        separators=SEPARATORS.get(name),
+        is_separator_regex=name in SEPARATORS,
+        chunk_size=CHUNK_SIZE,
+        chunk_overlap=CHUNK_OVERLAP,
+    )
     chunks = splitter.split_documents(docs)
     print(f"Split into {len(chunks)} chunks for {name}")
 
@@ -63,23 +129,32 @@ def build_index(name: str, docs: List):
             pass
 
     embeddings = GoogleGenerativeAIEmbeddings(model="models/text-embedding-004", google_api_key=GOOGLE_API_KEY)
-    vs = FAISS.from_documents(chunks, embeddings)
+    mat = embed_texts(embeddings, [c.page_content for c in chunks])
+    faiss.normalize_L2(mat)
+
+    index = make_index(mat)
+    index.add(mat)
+
+    ids = [str(uuid.uuid4()) for _ in chunks]
+    vs = FAISS(
+        embedding_function=embeddings,
+        index=index,
+        docstore=InMemoryDocstore(dict(zip(ids, chunks))),
+        index_to_docstore_id=dict(enumerate(ids)),
+        normalize_L2=True,
+        distance_strategy=DistanceStrategy.MAX_INNER_PRODUCT,
+    )
 
     out_dir = DATA_DIR / name
     vs.save_local(str(out_dir))
+    write_doc_meta(out_dir, chunks)
     print(f"Saved FAISS index to {out_dir}")
 
 
 def main():
-    all_docs = load_docs()
-    nec_docs = [d for d in all_docs if "NEC" in (d.metadata.get("source", "") + d.page_content[:100]) or str(NEC_PATH.name) in d.metadata.get("source", "")]
-    wm_docs = [d for d in all_docs if "Wattmonk" in (d.metadata.get("source", "") + d.page_content[:100]) or str(WM_PATH.name) in d.metadata.get("source", "")]
-
-    # Fallback: if heuristics fail, just split by file ext
-    if not nec_docs and NEC_PATH.exists():
-        nec_docs = PyPDFLoader(str(NEC_PATH)).load()
-    if not wm_docs and WM_PATH.exists():
-        wm_docs = Docx2txtLoader(str(WM_PATH)).load()
+    # Route by source file so each document is parsed exactly once
+    nec_docs = load_docs(NEC_PATH, PyPDFLoader, "NEC PDF")
+    wm_docs = load_docs(WM_PATH, Docx2txtLoader, "Wattmonk DOCX")
 
     build_index("nec", nec_docs)
     build_index("wattmonk", wm_docs)
@@ -1,4 +1,5 @@
-import sys, os, json
+import sys, os
+import orjson
 from dotenv import load_dotenv
 
 # CLI wrapper to run the RAG graph locally and print JSON to stdout
@@ -11,7 +12,7 @@ def main():
     from api import rag as ragmod
 
     body_text = sys.stdin.read() or "{}"
-    data = json.loads(body_text)
+    data = orjson.loads(body_text)
     # Allow client-provided key for local dev
     try:
         ragmod.KEY_OVERRIDE = data.get("apiKey") or None
@@ -19,20 +20,18 @@ def main():
         pass
     messages = data.get("messages", [])
     query = messages[-1].get("content") if messages else data.get("query", "")
-    state = {"query": query}
-    result = ragmod._graph.invoke(state)
+    result = ragmod.run_query(query)
     memory_summary = ragmod.summarize_history(messages)
 
     docs = result.get("docs", [])
     scores = result.get("scores", [])
     out_docs = []
     for i, d in enumerate(docs):
-        md = d.get("metadata", {}) if isinstance(d, dict) else {}
         out_docs.append({
             "id": i+1,
-            "text": d.get("text", "") if isinstance(d, dict) else "",
-            "source": (md or {}).get("source") or d.get("source") if isinstance(d, dict) else "",
-            "file": (md or {}).get("file", ""),
+            "text": d.get("text", ""),
+            "source": d.get("source", ""),
+            "file": d.get("file", ""),
             "score": scores[i] if i < len(scores) else 0.0,
         })
 
@@ -41,8 +40,9 @@ def main():
         "mode": result.get("mode", "general"),
         "docs": out_docs,
         "memory_summary": memory_summary,
+        "cache": ragmod._QUERY_CACHE.snapshot(),
     }
-    sys.stdout.write(json.dumps(resp))
+    sys.stdout.write(orjson.dumps(resp).decode())
 
 if __name__ == "__main__":
     main()
@@ -1,4 +1,8 @@
 import json
+from dotenv import load_dotenv
+
+load_dotenv()
+
 from api import rag as ragmod
 
 queries = [
@@ -8,15 +12,13 @@ queries = [
 ]
 
 for label, q in queries:
-    state = {"query": q}
-    res = ragmod._graph.invoke(state)
+    res = ragmod.run_query(q)
     print("--", label, "--")
     print(json.dumps({k: res.get(k) for k in ['intent','mode']}, ensure_ascii=False))
     docs = res.get('docs', [])
     scores = res.get('scores', [])
     print("docs:", len(docs))
     for i, d in enumerate(docs[:3]):
-        md = d.get('metadata', {}) if isinstance(d, dict) else {}
-        print(i+1, md.get('source', ''), md.get('file', ''), (d.get('text','') if isinstance(d, dict) else '')[:120].replace('\n',' '), scores[i] if i < len(scores) else None)
+        print(i+1, d.get('source', ''), d.get('file', ''), d.get('text', '')[:120].replace('\n',' '), scores[i] if i < len(scores) else None)
     print()
 